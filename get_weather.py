@@ -1,21 +1,37 @@
 ################################################################################
-# Grabs the local weather data and appends it to an XLS file  (Final Version)
+# Grabs the local weather data and appends it to a CSV file  (Final Version)
 # Code developed by Jeffrey D. Shaffer with assistance from Claude Sonnet
 # 2024-10-20
 #
-# Requires the following libraries:  requests, pandas, openpyxl
-# Install using:  pip install requests pandas openpyxl
+# Requires the following libraries:  requests, openpyxl
+# Install using:  pip install requests openpyxl
+# Optional:  pip install lxml orjson  (faster XLSX writing and JSON parsing)
 # Run using:  python3 get_weather.py
+# Export to Excel using:  python3 get_weather.py --export-xlsx  (add --force to rebuild an up-to-date file)
+# See all options using:  python3 get_weather.py --help
 #
 # If you are not in Japan, you'll want to go to open-meteo.com and select 
 # a different source as this one uses a Japanese source for the weather data.
 #
-# You can set your own latitude and longitude (find using the URL from Google Maps).
-# You can change the output file by editing output filename.
+# You can set your own latitude and longitude (find using the URL from Google Maps)
+# with --lat and --lon, or change the defaults in LATITUDE and LONGITUDE.
+# You can change the output file with --out, or change the default in CSV_FILE_NAME.
+# The XLSX export is written next to it, with the same name and an .xlsx extension.
+# If you are upgrading from the old version that logged straight to the XLSX file,
+# the first run copies its rows into the new CSV file so no history is lost.
 #
-# To record the wind direction in degrees, instead of compass directions, 
-# comment out the second wind_dir (with the convert_wind_to_compass function)
-# and uncomment the first wind_dir (with no convert function).
+# Each run only appends one line to the CSV file, which stays fast no matter
+# how large the log grows. The formatted XLSX file is rebuilt from the CSV
+# only when you ask for it with --export-xlsx.
+#
+# To record the wind direction in degrees, instead of compass directions,
+# run with --degrees. Keep those runs in their own file (using --out), since
+# both are written to the same wind_dir column.
+#
+# Each compass direction covers the 22.5 degrees centred on its bearing (N is
+# 348.75-11.25). Rows logged by older versions, including any copied over from
+# the old XLSX file, used sectors starting at each bearing instead (N was
+# 0-22.5, so e.g. 20 degrees was N and is now NNE).
 #
 # UNITS USED
 #    temperature    = °C
@@ -29,134 +45,380 @@
 #
 ################################################################################
 
+import argparse
+import csv
+import json
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 import os
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment
+import time
+import zipfile
+try:
+    from orjson import loads as json_loads  # faster JSON parsing, if installed
+except ImportError:
+    from json import loads as json_loads
 
 # Currently using the OpenMeteo JMA API
 # https://open-meteo.com/en/docs/jma-api
-# The lat and lon are for Shizuoka, Japan
+# The default lat and lon are for Shizuoka, Japan
 LATITUDE = '34.975'
 LONGITUDE = '138.4088016'
-URL = f'https://api.open-meteo.com/v1/forecast?latitude={LATITUDE}&longitude={LONGITUDE}&current=temperature_2m,relative_humidity_2m,apparent_temperature,is_day,precipitation,weather_code,cloud_cover,surface_pressure,wind_speed_10m,wind_direction_10m&timezone=Asia%2FTokyo&models=jma_seamless'
+
+
+# Function to build the API URL for a location
+def build_url(latitude, longitude):
+    return f'https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current=temperature_2m,relative_humidity_2m,apparent_temperature,is_day,precipitation,weather_code,cloud_cover,surface_pressure,wind_speed_10m,wind_direction_10m&timezone=Asia%2FTokyo&models=jma_seamless'
+
+
+# One shared session, so connections are reused and failed requests
+# (connection errors or busy server responses) are retried with a short backoff
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3,
+                                                         status_forcelist=[502, 503, 504],
+                                                         raise_on_status=False)))
+TIMEOUT = (3, 5)  # seconds to connect, seconds to wait for the response
+
+# Default output file
+CSV_FILE_NAME = 'shizuoka_wx_data.csv'
+
+# Cache of the last API response, so runs closer together than the API's
+# 15 minute update interval don't hit the network again
+CACHE_FILE_NAME = '.wx_cache.json'
+CACHE_SECONDS = 15 * 60
+
+# Fields read from the 'current' block of the API response
+CURRENT_FIELDS = ('temperature_2m', 'apparent_temperature', 'relative_humidity_2m', 'surface_pressure',
+                  'wind_speed_10m', 'wind_direction_10m', 'cloud_cover', 'precipitation')
+
+# Column order of the output file (matches the row built in get_weather_data)
+COLUMNS = ('date', 'time', 'temp', 'feels_like', 'humidity', 'pressure',
+           'wind_speed', 'wind_dir', 'cloud_cover', 'precipitation')
+
+# Column widths for the XLSX export: the longer of the header and the widest
+# expected value (e.g. '2024-10-20', '-10.5', '1013.2'), plus some padding
+COLUMN_WIDTHS = {
+    'date': 12,
+    'time': 10,
+    'temp': 7,
+    'feels_like': 12,
+    'humidity': 10,
+    'pressure': 10,
+    'wind_speed': 12,
+    'wind_dir': 10,
+    'cloud_cover': 13,
+    'precipitation': 15
+}
+
+
+# Compass directions, each covering 22.5 degrees centred on its bearing
+# (N is 348.75-11.25, NNE is 11.25-33.75, ...)
+COMPASS = ('N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+           'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW')
 
 
 # Function to convert wind direction (degrees) to compass directions 
 # (I find this much easier to understand that looking at degrees)
 def convert_wind_to_compass(wind_dir):
-    if wind_dir >= 0 and wind_dir < 22.5:
-    	wind_dir_compass = "N"
-    if wind_dir >= 22.5 and wind_dir < 45:
-    	wind_dir_compass = "NNE"
-    if wind_dir >= 45 and wind_dir < 67.5:
-    	wind_dir_compass = "NE"
-    if wind_dir >= 67.5 and wind_dir < 90:
-    	wind_dir_compass = "ENE"
-    if wind_dir >= 90 and wind_dir < 112.5:
-    	wind_dir_compass = "E"
-    if wind_dir >= 112.5 and wind_dir < 135:
-    	wind_dir_compass = "ESE"
-    if wind_dir >= 135 and wind_dir < 157.5:
-    	wind_dir_compass = "SE"
-    if wind_dir >= 157.5 and wind_dir < 180:
-    	wind_dir_compass = "SSE"
-    if wind_dir >= 180 and wind_dir < 202.5:
-    	wind_dir_compass = "S"
-    if wind_dir >= 202.5 and wind_dir < 225:
-    	wind_dir_compass = "SSW"
-    if wind_dir >= 225 and wind_dir < 247.5:
-    	wind_dir_compass = "SW"
-    if wind_dir >= 247.5 and wind_dir < 270:
-    	wind_dir_compass = "WSW"
-    if wind_dir >= 270 and wind_dir < 292.5:
-    	wind_dir_compass = "W"
-    if wind_dir >= 292.5 and wind_dir < 315:
-    	wind_dir_compass = "WNW"
-    if wind_dir >= 315 and wind_dir < 337.5:
-    	wind_dir_compass = "NW"
-    if wind_dir >= 337.5 and wind_dir < 360:
-    	wind_dir_compass = "NNW"
-    if wind_dir == 360:
-    	wind_dir_compass = "N"
-    return wind_dir_compass
+    return COMPASS[int((wind_dir % 360) / 22.5 + 0.5) % 16]
 
 
-# Function to get the weather data
-def get_weather_data():
-    response = requests.get(URL)
-    if response.status_code == 200:
-        data = response.json()
-        weather = {
-            'date': datetime.now().strftime('%Y-%m-%d'),
-            'time': datetime.now().strftime('%H:%M:%S'),
-            'temp': data['current']['temperature_2m'],
-            'feels_like': data['current']['apparent_temperature'],
-            'humidity': data['current']['relative_humidity_2m'],
-            'pressure': data['current']['surface_pressure'],
-            'wind_speed': float(f"{data['current']['wind_speed_10m']/3.6:.2f}"),
-#            'wind_dir': data['current']['wind_direction_10m'],                           # use this one for degrees
-            'wind_dir': convert_wind_to_compass(data['current']['wind_direction_10m']),   # use this one for compass directions
-            'cloud_cover': data['current']['cloud_cover'],
-            'precipitation': data['current']['precipitation']
-        }
-        return weather
+# Function to pull the CURRENT_FIELDS values out of an API response, checking
+# that each one is a number (raises ValueError naming the first one that isn't)
+def read_current_fields(data):
+    current = data.get('current') if isinstance(data, dict) else None
+    if not isinstance(current, dict):
+        raise ValueError("missing field 'current'")
+    values = []
+    for field in CURRENT_FIELDS:
+        value = current.get(field)
+        if not isinstance(value, (int, float)):
+            raise ValueError(f'field {field!r} is missing or not a number ({value!r})')
+        values.append(value)
+    return values
+
+
+# Function to load the cached API response (empty if missing, unreadable or
+# not in the shape written by fetch_current_weather, e.g. hand-edited)
+def load_cache():
+    try:
+        with open(CACHE_FILE_NAME, 'rb') as cache_file:
+            cache = json_loads(cache_file.read())
+    except (OSError, ValueError):
+        return {}
+    if (not isinstance(cache, dict)
+            or not isinstance(cache.get('url'), str)
+            or not isinstance(cache.get('fetched_at'), (int, float))
+            or not isinstance(cache.get('data'), dict)):
+        return {}
+    return cache
+
+
+# Function to fetch the current weather values (in CURRENT_FIELDS order), using
+# the cached API response when it is still fresh and a conditional request
+# (ETag / Last-Modified) when it is not
+def fetch_current_weather(url):
+    cache = load_cache()
+    if cache.get('url') != url:
+        cache = {}  # cached response is for a different location
     else:
-        print('Error fetching weather data')
+        try:
+            values = read_current_fields(cache['data'])
+        except ValueError:
+            cache = {}  # cached response is unusable, so fetch a fresh one unconditionally
+        else:
+            # (a negative age means the clock went backwards, so the cache can't be trusted)
+            if 0 <= time.time() - cache['fetched_at'] < CACHE_SECONDS:
+                return values
+
+    headers = {}
+    if cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+
+    try:
+        response = SESSION.get(url, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 304:
+            if 'data' not in cache:
+                # Nothing was cached for this URL, so no conditional request was sent
+                print('Error fetching weather data: unexpected 304 Not Modified with nothing cached')
+                return None
+            data = cache['data']
+        else:
+            response.raise_for_status()
+            data = json_loads(response.content)
+    except requests.HTTPError as error:
+        print(f'Error fetching weather data: {error}\n{error.response.text[:200]}')
+        return None
+    except requests.RequestException as error:
+        print(f'Error fetching weather data: {error}')
+        return None
+    except ValueError as error:  # a 200 response whose body isn't JSON (e.g. a proxy error page)
+        print(f'Error decoding weather data: {error}\n{response.text[:200]}')
+        return None
+
+    # Give up cleanly on an unusable response (rather than crashing or logging
+    # an incomplete row), and don't cache it, so the next run tries again
+    try:
+        values = read_current_fields(data)
+    except ValueError as error:
+        print(f'Unusable weather data: {error}')
         return None
 
+    cache = {
+        'url': url,
+        'fetched_at': time.time(),
+        'etag': response.headers.get('ETag', cache.get('etag')),
+        'last_modified': response.headers.get('Last-Modified', cache.get('last_modified')),
+        'data': data
+    }
+    # The cache is only an optimization, so a failed write (read-only directory,
+    # full disk) shouldn't stop this run's data from being saved
+    try:
+        with open(CACHE_FILE_NAME, 'w') as cache_file:
+            json.dump(cache, cache_file)
+    except OSError:
+        pass
+    return values
+
+
+# Function to get the weather data
+def get_weather_data(url, compass=True):
+    values = fetch_current_weather(url)
+    if values is None:
+        return None
+    temp, feels_like, humidity, pressure, wind_speed_kph, wind_dir, cloud_cover, precipitation = values
+
+    if compass:
+        wind_dir = convert_wind_to_compass(wind_dir)
+    now = datetime.now()  # read the clock once so date and time always agree
+
+    # One row of values, in the same order as COLUMNS
+    weather = (
+        now.strftime('%Y-%m-%d'),          # date
+        now.strftime('%H:%M:%S'),          # time
+        temp,                              # temp
+        feels_like,                        # feels_like
+        humidity,                          # humidity
+        pressure,                          # pressure
+        round(wind_speed_kph / 3.6, 2),    # wind_speed
+        wind_dir,                          # wind_dir
+        cloud_cover,                       # cloud_cover
+        precipitation                      # precipitation
+    )
+    return weather
+
+
+# Function to check whether a file is missing or empty (e.g. left behind by a
+# crashed run), using a single stat() call
+def file_is_empty(file_name):
+    try:
+        return os.stat(file_name).st_size == 0
+    except FileNotFoundError:
+        return True
+
+
+# Function to create or append to the CSV file
+def save_weather_data(weather_data, csv_file_name):
+    new_file = file_is_empty(csv_file_name)
+
+    # Append a single line, writing the header row first if the file is new
+    with open(csv_file_name, 'a', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        if new_file:
+            writer.writerow(COLUMNS)
+        writer.writerow(weather_data)
+
+
+# Function to start the CSV log from an existing Excel file, so upgrading from
+# the old version (which logged straight to the XLSX file) doesn't lose history.
+# Returns False if the Excel file couldn't be read.
+def seed_csv_from_excel(csv_file_name, xlsx_file_name):
+    # openpyxl is only needed for this one-time upgrade
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    # Copy into a temporary file and swap it in, so an interrupted copy can never
+    # leave a partial CSV log that looks like the full history
+    temp_file_name = csv_file_name + '.tmp'
+    try:
+        workbook = load_workbook(xlsx_file_name, read_only=True)
+        try:
+            with open(temp_file_name, 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                for row in workbook.active.iter_rows(values_only=True):
+                    writer.writerow(['' if value is None else value for value in row])
+        finally:
+            workbook.close()
+        os.replace(temp_file_name, csv_file_name)
+    except (OSError, zipfile.BadZipFile, InvalidFileException) as error:
+        print(f"Warning: could not copy the existing rows from {xlsx_file_name}: {error}")
+        return False
+    finally:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+    return True
 
-# Function to adjust column width and center cell content
-def adjust_column_width_and_center(file_name):
-    workbook = load_workbook(file_name)
-    worksheet = workbook.active
-
-    # Iterate over all rows and columns to apply alignment and adjust column width
-    for col in worksheet.columns:
-        max_length = 0
-        column = col[0].column_letter  # Get the column letter (e.g., A, B, C, ...)
-        
-        for cell in col:
-            # Apply center alignment to each cell
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            # Calculate maximum length of data in the column
-            if cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        
-        # Adjust column width based on the longest value
-        adjusted_width = max_length + 2  # Add some padding for readability
-        worksheet.column_dimensions[column].width = adjusted_width
-
-    workbook.save(file_name)
-
-
-# Function to create or append to the Excel file
-def save_weather_data(weather_data):
-    file_name = 'shizuoka_wx_data.xlsx'
-
-    # Check if file exists, if not create a new file
-    if not os.path.exists(file_name):
-        df = pd.DataFrame([weather_data])
-        df.to_excel(file_name, index=False)
-    else:
-        # If file exists, append the new data
-        df = pd.read_excel(file_name)
-        df = df._append(weather_data, ignore_index=True)
-        df.to_excel(file_name, index=False)
 
-    # Adjust the column width and center the content
-    adjust_column_width_and_center(file_name)
+# Function to convert a CSV field back into a number where possible
+# (so Excel sees numbers instead of text)
+def parse_csv_value(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+# Function to rebuild the Excel file from the CSV log, with centered content
+def export_to_excel(csv_file_name, xlsx_file_name):
+    # openpyxl is only needed here, so the regular hourly run doesn't pay for importing it
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment
+    from openpyxl.utils import get_column_letter
+
+    # Stream the rows out in write-only mode instead of building the whole sheet in memory
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('weather')
+    center = Alignment(horizontal='center', vertical='center')  # one shared style for every cell
+
+    # Wrap a row of values in centered cells
+    def centered_row(values):
+        row = []
+        for value in values:
+            cell = WriteOnlyCell(worksheet, value=value)
+            cell.alignment = center
+            row.append(cell)
+        return row
+
+    with open(csv_file_name, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+
+        # The widths are fixed by the schema, so they can be set up front
+        # (write-only mode requires that) without scanning the data first
+        for index, name in enumerate(header, start=1):
+            worksheet.column_dimensions[get_column_letter(index)].width = COLUMN_WIDTHS.get(name, len(name) + 2)
+
+        worksheet.append(centered_row(header))
+        for row in reader:
+            worksheet.append(centered_row([parse_csv_value(value) for value in row]))
+
+    # Save to a temporary file and swap it in, so an interrupted export can never
+    # leave a broken XLSX file that looks newer than the CSV log
+    temp_file_name = xlsx_file_name + '.tmp'
+    try:
+        workbook.save(temp_file_name)
+        os.replace(temp_file_name, xlsx_file_name)
+    finally:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+
+
+# Function to check whether the Excel file already has everything in the CSV log
+# (the CSV only ever changes by appending, so comparing timestamps is enough;
+# equal timestamps count as stale, since some filesystems only store whole seconds)
+def excel_is_up_to_date(csv_file_name, xlsx_file_name):
+    try:
+        return os.path.getmtime(xlsx_file_name) > os.path.getmtime(csv_file_name)
+    except OSError:
+        return False
 
 
 # Main function to get weather data and save it
 def main():
-    weather_data = get_weather_data()
+    parser = argparse.ArgumentParser(description='Log the current weather to a CSV file.')
+    parser.add_argument('--lat', type=float, default=LATITUDE, help=f'latitude of the location (default: {LATITUDE})')
+    parser.add_argument('--lon', type=float, default=LONGITUDE, help=f'longitude of the location (default: {LONGITUDE})')
+    parser.add_argument('--out', default=CSV_FILE_NAME, help=f'CSV file to append to (default: {CSV_FILE_NAME})')
+    parser.add_argument('--degrees', action='store_true',
+                        help='record the wind direction in degrees instead of compass directions '
+                             '(use a separate --out file, don\'t mix both in one log)')
+    parser.add_argument('--export-xlsx', action='store_true',
+                        help='rebuild the XLSX file from the CSV file instead of fetching new data')
+    parser.add_argument('--force', action='store_true',
+                        help='with --export-xlsx, rebuild the XLSX file even if it looks up to date')
+    args = parser.parse_args()
+    xlsx_file_name = os.path.splitext(args.out)[0] + '.xlsx'
+
+    # Carry over the rows from an Excel log written by the old version before
+    # anything is appended to (or exported from) the new CSV log
+    excel_is_unreadable = False
+    if file_is_empty(args.out) and os.path.exists(xlsx_file_name):
+        if seed_csv_from_excel(args.out, xlsx_file_name):
+            print(f"Copied the existing rows from {xlsx_file_name} into {args.out}.")
+        else:
+            # Keep the unreadable file out of the way of later exports, which
+            # would otherwise overwrite it (it may still be recoverable by hand)
+            unreadable_file_name = xlsx_file_name + '.unreadable'
+            try:
+                os.replace(xlsx_file_name, unreadable_file_name)
+                print(f"Moved it to {unreadable_file_name}; logging continues in {args.out}.")
+            except OSError:
+                excel_is_unreadable = True
+
+    if args.export_xlsx:
+        if excel_is_unreadable:
+            print(f"Not exporting, {xlsx_file_name} could not be read and would be overwritten.")
+            return
+        if file_is_empty(args.out):
+            print(f"No data to export, {args.out} does not exist or is empty.")
+            return
+        if not args.force and excel_is_up_to_date(args.out, xlsx_file_name):
+            print(f"{xlsx_file_name} is already up to date (use --force to rebuild it anyway).")
+            return
+        export_to_excel(args.out, xlsx_file_name)
+        print(f"Weather data exported to {xlsx_file_name} successfully.")
+        return
+
+    weather_data = get_weather_data(build_url(args.lat, args.lon), compass=not args.degrees)
     if weather_data:
-        save_weather_data(weather_data)
-        print(f"Weather data for {weather_data['date']} saved successfully.")
+        save_weather_data(weather_data, args.out)
+        print(f"Weather data for {weather_data[0]} saved successfully.")
     else:
         print("Failed to retrieve weather data.")
 